@@ -2,9 +2,11 @@ import logging
 import warnings
 from collections.abc import Iterable as IterableClass
 from collections.abc import Sequence
+from functools import lru_cache
 from typing import Literal, Optional, Union
 
 import jax
+import numba
 import numpy as np
 import scipy.sparse as sp_sparse
 import torch
@@ -70,6 +72,24 @@ def get_max_epochs_heuristic(
     return max_epochs
 
 
+@lru_cache(maxsize=32)
+def _cached_accelerator_flags(accelerator: str, devices: Union[int, tuple[int], str]) -> tuple:
+    """Resolves accelerator and devices flags, caching the hardware probing per arguments."""
+    connector = _AcceleratorConnector(
+        accelerator=accelerator, devices=list(devices) if isinstance(devices, tuple) else devices
+    )
+    _devices = connector._devices_flag
+    return connector._accelerator_flag, tuple(_devices) if isinstance(_devices, list) else _devices
+
+
+def _get_accelerator_flags(accelerator: str, devices: Union[int, list[int], str]) -> tuple:
+    """Hashable front-end to :func:`_cached_accelerator_flags`."""
+    _accelerator, _devices = _cached_accelerator_flags(
+        accelerator, tuple(devices) if isinstance(devices, list) else devices
+    )
+    return _accelerator, list(_devices) if isinstance(_devices, tuple) else _devices
+
+
 @devices_dsp.dedent
 def parse_device_args(
     accelerator: str = "auto",
@@ -97,9 +117,7 @@ def parse_device_args(
     if _validate_single_device and (cond1 or cond2 or cond3):
         raise ValueError("Only a single device can be specified for `device`.")
 
-    connector = _AcceleratorConnector(accelerator=accelerator, devices=devices)
-    _accelerator = connector._accelerator_flag
-    _devices = connector._devices_flag
+    _accelerator, _devices = _get_accelerator_flags(accelerator, devices)
 
     if _accelerator in ["tpu", "ipu", "hpu"]:
         warnings.warn(
@@ -110,9 +128,7 @@ def parse_device_args(
         )
     elif _accelerator == "mps" and accelerator == "auto":
         # auto accelerator should not default to mps
-        connector = _AcceleratorConnector(accelerator="cpu", devices=devices)
-        _accelerator = connector._accelerator_flag
-        _devices = connector._devices_flag
+        _accelerator, _devices = _get_accelerator_flags("cpu", devices)
     elif _accelerator == "mps" and accelerator != "auto":
         warnings.warn(
             "`accelerator` has been set to `mps`. Please note that not all PyTorch "
@@ -172,38 +188,43 @@ def scrna_raw_counts_properties(
     type
         Dict of ``np.ndarray`` containing, by pair (one for each sub-population),
         mean expression per gene, proportion of non-zero expression per gene, mean of normalized
-        expression.
+        expression. Cells with zero total counts have a normalized expression of zero.
     """
     adata = adata_manager.adata
     data = adata_manager.get_from_registry(REGISTRY_KEYS.X_KEY)
-    data1 = data[idx1]
-    data2 = data[idx2]
-    if var_idx is not None:
-        data1 = data1[:, var_idx]
-        data2 = data2[:, var_idx]
-
-    mean1 = np.asarray((data1).mean(axis=0)).ravel()
-    mean2 = np.asarray((data2).mean(axis=0)).ravel()
-    nonz1 = np.asarray((data1 != 0).mean(axis=0)).ravel()
-    nonz2 = np.asarray((data2 != 0).mean(axis=0)).ravel()
 
+    # cached in `uns` as a float32 vector, recomputed if its length no longer matches n_obs
     key = "_scvi_raw_norm_scaling"
-    if key not in adata.obs.keys():
-        scaling_factor = 1 / np.asarray(data.sum(axis=1)).ravel().reshape(-1, 1)
-        scaling_factor *= 1e4
-        adata.obs[key] = scaling_factor.ravel()
-    else:
-        scaling_factor = adata.obs[key].to_numpy().ravel().reshape(-1, 1)
-
-    if issubclass(type(data), sp_sparse.spmatrix):
-        norm_data1 = data1.multiply(scaling_factor[idx1])
-        norm_data2 = data2.multiply(scaling_factor[idx2])
+    scaling_factor = adata.uns.get(key, None)
+    if scaling_factor is None or scaling_factor.shape[0] != adata.n_obs:
+        row_sums = np.asarray(data.sum(axis=1)).ravel()
+        # zero-count cells get a zero instead of an infinite scaling, so that the sparse and
+        # dense paths agree instead of producing inf * 0 = NaN
+        scaling_factor = np.divide(
+            1e4, row_sums, out=np.zeros(row_sums.shape, dtype=np.float64), where=row_sums != 0
+        ).astype(np.float32)
+        adata.uns[key] = scaling_factor
+
+    if sp_sparse.issparse(data):
+        (mean1, nonz1, norm_mean1), (mean2, nonz2, norm_mean2) = _sparse_col_stats(
+            data, [idx1, idx2], scaling_factor, var_idx
+        )
     else:
-        norm_data1 = data1 * scaling_factor[idx1] #(data1.T * scaling_factor[idx1]).T #data1 * scaling_factor[idx1]
-        norm_data2 = data2 * scaling_factor[idx2] #(data2.T * scaling_factor[idx2]).T #data2 * scaling_factor[idx2]
-
-    norm_mean1 = np.asarray(norm_data1.mean(axis=0)).ravel()
-    norm_mean2 = np.asarray(norm_data2.mean(axis=0)).ravel()
+        data1 = data[idx1]
+        data2 = data[idx2]
+        if var_idx is not None:
+            data1 = data1[:, var_idx]
+            data2 = data2[:, var_idx]
+
+        n1, n2 = data1.shape[0], data2.shape[0]
+        mean1 = np.asarray(data1.sum(axis=0)).ravel() / n1
+        mean2 = np.asarray(data2.sum(axis=0)).ravel() / n2
+        nonz1 = np.count_nonzero(data1, axis=0) / n1
+        nonz2 = np.count_nonzero(data2, axis=0) / n2
+
+        # weighted column sums instead of materializing the scaled submatrices
+        norm_mean1 = np.asarray(scaling_factor[idx1] @ data1).ravel() / n1
+        norm_mean2 = np.asarray(scaling_factor[idx2] @ data2).ravel() / n2
 
     properties = {
         "raw_mean1": mean1,
@@ -215,6 +236,133 @@ def scrna_raw_counts_properties(
     }
     return properties
 
+
+# upper bound on the number of float64 entries of the per-thread buffers of `_csr_col_stats`
+_CSR_COL_STATS_BUFFER_SIZE = 2**22
+
+
+@numba.njit(parallel=True, cache=True)
+def _csr_col_stats(indptr, indices, data, rows, row_weights, scaling, col_map, n_out, n_threads, buffer_size):
+    """Per-column weighted sum, nonzero count and scaled sum of CSR rows.
+
+    ``row_weights`` holds one row weighting per population, so all populations are reduced in a
+    single pass over ``rows``. Rows are split into one chunk per thread, each accumulating into
+    its own buffer so that no two threads write to the same column counter. At most
+    ``n_threads`` chunks are used, and fewer when the buffers would exceed ``buffer_size``
+    entries in total. Both are arguments rather than globals so that the kernel can be cached.
+    """
+    n_groups = row_weights.shape[0]
+    n_rows = rows.shape[0]
+    max_chunks = buffer_size // max(n_groups * 3 * n_out, 1)
+    n_chunks = max(min(n_threads, n_rows, max_chunks), 1)
+    chunk_size = (n_rows + n_chunks - 1) // n_chunks
+    stats = np.zeros((n_chunks, n_groups, 3, n_out))
+    for c in numba.prange(n_chunks):
+        for i in range(c * chunk_size, min((c + 1) * chunk_size, n_rows)):
+            row = rows[i]
+            for k in range(indptr[row], indptr[row + 1]):
+                j = col_map[indices[k]]
+                if j < 0 or data[k] == 0:
+                    continue
+                for g in range(n_groups):
+                    weight = row_weights[g, row]
+                    if weight == 0:
+                        continue
+                    stats[c, g, 0, j] += weight * data[k]
+                    stats[c, g, 1, j] += weight
+                    stats[c, g, 2, j] += weight * data[k] * scaling[row]
+    out = stats[0].copy()
+    for c in range(1, n_chunks):
+        out += stats[c]
+    return out
+
+
+def _sparse_col_stats(
+    data: sp_sparse.spmatrix,
+    idxs: list[Union[list[int], np.ndarray]],
+    scaling_factor: np.ndarray,
+    var_idx: Optional[Union[list[int], np.ndarray]] = None,
+) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Mean, proportion of non-zeros and mean of scaled values per column of each ``data[idx]``.
+
+    Equivalent to slicing ``data[idx][:, var_idx]`` and reducing it for every ``idx`` in
+    ``idxs``, without materializing the submatrices or the boolean ``!= 0`` matrices.
+    """
+    if data.format != "csr":
+        data = data.tocsr()
+    n_obs, n_vars = data.shape
+    selections = [np.arange(n_obs)[np.asarray(idx).ravel()] for idx in idxs]
+    # number of times each row is selected, so repeated indices count like in `data[idx]`
+    row_weights = np.stack([np.bincount(rows, minlength=n_obs) for rows in selections])
+    rows = np.flatnonzero(row_weights.any(axis=0))
+
+    if var_idx is None:
+        cols = np.arange(n_vars)
+        inverse = None
+    else:
+        cols, inverse = np.unique(np.arange(n_vars)[var_idx], return_inverse=True)
+    col_map = np.full(n_vars, -1, dtype=np.int64)
+    col_map[cols] = np.arange(len(cols))
+
+    stats = _csr_col_stats(
+        data.indptr,
+        data.indices,
+        data.data,
+        rows,
+        row_weights,
+        scaling_factor,
+        col_map,
+        len(cols),
+        numba.get_num_threads(),
+        _CSR_COL_STATS_BUFFER_SIZE,
+    )
+    stats = stats / np.array([len(rows) for rows in selections]).reshape(-1, 1, 1)
+    if inverse is not None:
+        stats = stats[..., inverse]
+    return [tuple(group_stats) for group_stats in stats]
+
+
+def _sparse_col_positive_proportion(
+    data: sp_sparse.spmatrix,
+    idxs: list[Union[list[int], np.ndarray]],
+    var_idx: Optional[Union[list[int], np.ndarray]] = None,
+) -> list[np.ndarray]:
+    """Proportion of positive entries per column of each ``data[idx]``.
+
+    Equivalent to slicing ``data[idx][:, var_idx]`` and counting its ``> 0`` entries for every
+    ``idx`` in ``idxs``. For CSR input only the ``indptr`` ranges of the selected rows are
+    visited; CSC input is reduced per column through the cumulative entry weights at its
+    ``indptr`` bounds. Other formats are converted to CSR once for all populations.
+    """
+    if data.format not in ("csr", "csc"):
+        data = data.tocsr()
+    n_obs, n_vars = data.shape
+    selections = [np.arange(n_obs)[np.asarray(idx).ravel()] for idx in idxs]
+    # number of times each row is selected, so repeated indices count like in `data[idx]`
+    row_weights = np.stack([np.bincount(rows, minlength=n_obs) for rows in selections])
+    if data.format == "csr":
+        rows = np.flatnonzero(row_weights.any(axis=0))
+        starts = data.indptr[rows]
+        lengths = data.indptr[rows + 1] - starts
+        # positions of the stored entries of the selected rows, row after row
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        positive = data.data[entries] > 0
+        entry_cols = data.indices[entries[positive]]
+        entry_weights = np.repeat(row_weights[:, rows], lengths, axis=1)[:, positive]
+        counts = np.stack(
+            [np.bincount(entry_cols, weights=weights, minlength=n_vars) for weights in entry_weights]
+        )
+    else:
+        entry_weights = row_weights[:, data.indices] * (data.data > 0)
+        cumulative = np.zeros((len(selections), entry_weights.shape[1] + 1))
+        np.cumsum(entry_weights, axis=1, out=cumulative[:, 1:])
+        counts = cumulative[:, data.indptr[1:]] - cumulative[:, data.indptr[:-1]]
+    proportions = counts / np.array([len(rows) for rows in selections]).reshape(-1, 1)
+    if var_idx is not None:
+        proportions = proportions[:, var_idx]
+    return list(proportions)
+
+
 def scatac_raw_counts_properties(
     adata_manager: AnnDataManager,
     idx1: Union[list[int], np.ndarray],
@@ -240,13 +388,16 @@ def scatac_raw_counts_properties(
         Dict of ``np.ndarray`` containing, by pair (one for each sub-population).
     """
     data = adata_manager.get_from_registry(REGISTRY_KEYS.X_KEY)
-    data1 = data[idx1]
-    data2 = data[idx2]
-    if var_idx is not None:
-        data1 = data1[:, var_idx]
-        data2 = data2[:, var_idx]
-    mean1 = np.asarray((data1 > 0).mean(axis=0)).ravel()
-    mean2 = np.asarray((data2 > 0).mean(axis=0)).ravel()
+    if sp_sparse.issparse(data):
+        mean1, mean2 = _sparse_col_positive_proportion(data, [idx1, idx2], var_idx)
+    else:
+        data1 = data[idx1]
+        data2 = data[idx2]
+        if var_idx is not None:
+            data1 = data1[:, var_idx]
+            data2 = data2[:, var_idx]
+        mean1 = np.count_nonzero(data1 > 0, axis=0) / data1.shape[0]
+        mean2 = np.count_nonzero(data2 > 0, axis=0) / data2.shape[0]
     properties = {"emp_mean1": mean1, "emp_mean2": mean2, "emp_effect": (mean1 - mean2)}
     return properties
 
@@ -256,15 +407,21 @@ def _get_batch_code_from_category(
     if not isinstance(category, IterableClass) or isinstance(category, str):
         category = [category]
 
-    batch_mappings = adata_manager.get_state_registry(REGISTRY_KEYS.BATCH_KEY).categorical_mapping
+    # the state registry does not change once registered, so the inverted mapping is cached
+    batch_locs = getattr(adata_manager, "_batch_locs", None)
+    if batch_locs is None:
+        batch_registry = adata_manager.get_state_registry(REGISTRY_KEYS.BATCH_KEY)
+        batch_locs = {cat: loc for loc, cat in enumerate(batch_registry.categorical_mapping)}
+        adata_manager._batch_locs = batch_locs
     batch_code = []
     for cat in category:
         if cat is None:
             batch_code.append(None)
-        elif cat not in batch_mappings:
+        elif cat not in batch_locs:
             raise ValueError(f'"{cat}" not a valid batch category.')
         else:
-            batch_loc = np.where(batch_mappings == cat)[0][0]
-            batch_code.append(batch_loc)
-    return batch_code
+            batch_code.append(batch_locs[cat])
+    if None in batch_code:
+        return np.array(batch_code, dtype=object)
+    return np.fromiter(batch_code, dtype=np.int64, count=len(batch_code))
 
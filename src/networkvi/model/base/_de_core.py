@@ -13,6 +13,11 @@ from ._differential import DifferentialComputation
 logger = logging.getLogger(__name__)
 
 
+def _n_selected(idx: np.ndarray) -> int:
+    """Number of observations selected by a boolean mask or an array of indices."""
+    return int(np.count_nonzero(idx)) if idx.dtype == bool else idx.size
+
+
 def _prepare_obs(
     idx1: Union[list[bool], np.ndarray, str],
     idx2: Union[list[bool], np.ndarray, str],
@@ -23,8 +28,8 @@ def _prepare_obs(
     Given population identifiers `idx1` and potentially `idx2`,
     this function creates an array `obs_col` that identifies both populations
     for observations contained in `adata`.
-    In particular, `obs_col` will take values `group1` (resp. `group2`)
-    for `idx1` (resp `idx2`).
+    In particular, `obs_col` is an ``int8`` code array taking values `group1` (resp. `group2`),
+    i.e. ``1`` (resp. ``2``), for `idx1` (resp `idx2`) and ``0`` elsewhere.
 
     Parameters
     ----------
@@ -39,23 +44,24 @@ def _prepare_obs(
     """
 
     def ravel_idx(my_idx, obs_df):
+        # `eval` yields the boolean mask `query` would index with, without building the subset
         return (
-            obs_df.index.isin(obs_df.query(my_idx).index)
+            obs_df.eval(my_idx).to_numpy(dtype=bool)
             if isinstance(my_idx, str)
             else np.asarray(my_idx).ravel()
         )
 
     obs_df = adata.obs
     idx1 = ravel_idx(idx1, obs_df)
-    g1_key = "one"
-    obs_col = np.array(["None"] * adata.shape[0], dtype=str)
+    g1_key = 1
+    obs_col = np.zeros(adata.shape[0], dtype=np.int8)
     obs_col[idx1] = g1_key
     group1 = [g1_key]
-    group2 = None if idx2 is None else "two"
+    group2 = None if idx2 is None else 2
     if idx2 is not None:
         idx2 = ravel_idx(idx2, obs_df)
         obs_col[idx2] = group2
-    if (obs_col[idx1].shape[0] == 0) or (obs_col[idx2].shape[0] == 0):
+    if _n_selected(idx1) == 0 or (idx2 is not None and _n_selected(idx2) == 0):
         raise ValueError("One of idx1 or idx2 has size zero.")
     return obs_col, group1, group2
 
@@ -91,26 +97,30 @@ def _de_core(
     if not isinstance(group1, IterableClass) or isinstance(group1, str):
         group1 = [group1]
 
-    # make a temp obs key using indices
-    temp_key = None
+    # populations are compared through integer codes; groups absent from the codes map to -2,
+    # which matches no cell, like comparing a categorical column to an unknown value
     if idx1 is not None:
         obs_col, group1, group2 = _prepare_obs(idx1, idx2, adata)
-        temp_key = "_scvi_temp_de"
-        adata.obs[temp_key] = obs_col
-        groupby = temp_key
+        group_codes = {group1[0]: group1[0], group2: group2}
+    else:
+        obs_groups = adata.obs[groupby].astype("category")
+        obs_col = obs_groups.cat.codes.to_numpy()
+        group_codes = {group: code for code, group in enumerate(obs_groups.cat.categories)}
 
+    sort_key = "proba_de" if mode == "change" else "bayes_factor"
     df_results = []
+    df_index = []
     dc = DifferentialComputation(model_fn, representation_fn, adata_manager)
     for g1 in track(
         group1,
         description="DE...",
         disable=silent,
     ):
-        cell_idx1 = (adata.obs[groupby] == g1).to_numpy().ravel()
+        cell_idx1 = obs_col == group_codes.get(g1, -2)
         if group2 is None:
             cell_idx2 = ~cell_idx1
         else:
-            cell_idx2 = (adata.obs[groupby] == group2).to_numpy().ravel()
+            cell_idx2 = obs_col == group_codes.get(group2, -2)
 
         all_info = dc.get_bayes_factors(
             cell_idx1,
@@ -127,22 +137,26 @@ def _de_core(
             genes_properties_dict = all_stats_fn(adata_manager, cell_idx1, cell_idx2)
             all_info = {**all_info, **genes_properties_dict}
 
-        res = pd.DataFrame(all_info, index=col_names)
-        sort_key = "proba_de" if mode == "change" else "bayes_factor"
-        res = res.sort_values(by=sort_key, ascending=False)
+        # collect sorted columns per group and build the DataFrame once at the end
+        n_genes = len(col_names)
+        order = np.argsort(-np.asarray(all_info[sort_key]), kind="stable")
+        res = {key: np.broadcast_to(val, (n_genes,))[order] for key, val in all_info.items()}
         if mode == "change":
-            res[f"is_de_fdr_{fdr}"] = _fdr_de_prediction(res["proba_de"], fdr=fdr)
+            res[f"is_de_fdr_{fdr}"] = _fdr_de_prediction(
+                pd.Series(res["proba_de"]), fdr=fdr
+            ).to_numpy()
         if idx1 is None:
             g2 = "Rest" if group2 is None else group2
-            res["comparison"] = f"{g1} vs {g2}"
-            res["group1"] = g1
-            res["group2"] = g2
+            res["comparison"] = np.full(n_genes, f"{g1} vs {g2}")
+            res["group1"] = np.full(n_genes, g1)
+            res["group2"] = np.full(n_genes, g2)
         df_results.append(res)
+        df_index.append(order)
 
-    if temp_key is not None:
-        del adata.obs[temp_key]
-
-    result = pd.concat(df_results, axis=0)
+    result = pd.DataFrame(
+        {key: np.concatenate([res[key] for res in df_results]) for key in df_results[0]},
+        index=pd.Index(col_names).take(np.concatenate(df_index)),
+    )
 
     return result
 
@@ -151,11 +165,19 @@ def _fdr_de_prediction(posterior_probas: pd.Series, fdr: float = 0.05) -> pd.Ser
     """Compute posterior expected FDR and tag features as DE."""
     if not posterior_probas.ndim == 1:
         raise ValueError("posterior_probas should be 1-dimensional")
-    original_index = posterior_probas.index
-    sorted_pgs = posterior_probas.sort_values(ascending=False)
-    cumulative_fdr = (1.0 - sorted_pgs).cumsum() / (1.0 + np.arange(len(sorted_pgs)))
+    probas = posterior_probas.to_numpy()
+    # `_de_core` passes probabilities already sorted in descending order
+    if posterior_probas.is_monotonic_decreasing:
+        order = None
+        sorted_pgs = probas
+    else:
+        order = np.argsort(-probas, kind="stable")
+        sorted_pgs = probas[order]
+    cumulative_fdr = np.cumsum(1.0 - sorted_pgs) / (1.0 + np.arange(len(sorted_pgs)))
     d = (cumulative_fdr <= fdr).sum()
-    is_pred_de = pd.Series(np.zeros_like(cumulative_fdr).astype(bool), index=sorted_pgs.index)
-    is_pred_de.iloc[:d] = True
-    is_pred_de = is_pred_de.loc[original_index]
-    return is_pred_de
+    is_pred_de = np.zeros(len(probas), dtype=bool)
+    if order is None:
+        is_pred_de[:d] = True
+    else:
+        is_pred_de[order[:d]] = True
+    return pd.Series(is_pred_de, index=posterior_probas.index)
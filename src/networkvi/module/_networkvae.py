@@ -1,3 +1,4 @@
+import contextlib
 from collections.abc import Iterable
 from typing import Literal, Optional, Union
 
@@ -39,6 +40,13 @@ class GatingNetwork(nn.Module):
         The dimensionality of the latent space for each expert.
     num_experts : int
         The total number of experts in the Mixture of Experts model.
+    block_structured : bool
+        If True, each expert's logit is computed from its own mean, variance and mask only
+        (a grouped 1x1 convolution), followed by a small linear layer mixing the experts'
+        logits. Uses a factor of ``num_experts`` fewer parameters and FLOPs than the dense layer.
+    autocast_bf16 : bool
+        If True, the gating layer runs under bfloat16 autocast; the softmax stays in the
+        input precision.
 
     Examples
     --------
@@ -51,37 +59,87 @@ class GatingNetwork(nn.Module):
     torch.Size([8, 4])
     """
 
-    def __init__(self, latent_dim, num_experts):
+    def __init__(self, latent_dim, num_experts, block_structured=False, autocast_bf16=False):
         super(GatingNetwork, self).__init__()
         input_dim = 2 * num_experts * latent_dim + num_experts  # Means + logvars + mask
-        self.fc = nn.Linear(input_dim, num_experts)
+        self.latent_dim = latent_dim
+        self.block_structured = block_structured
+        self.autocast_bf16 = autocast_bf16
+        if block_structured:
+            self.expert_fc = nn.Conv1d(input_dim, num_experts, kernel_size=1, groups=num_experts)
+            self.expert_mixing = nn.Linear(num_experts, num_experts)
+        else:
+            self.fc = nn.Linear(input_dim, num_experts)
+
+    def _gating_input(self, means, logvars, masks):
+        """Flatten the expert posteriors and masks into the input of the gating layer."""
+        if torch.is_tensor(means):
+            # already stacked: (batch_size, num_experts, latent_dim), flattening is a view
+            if self.block_structured:
+                return torch.cat([means, logvars, masks.unsqueeze(-1)], dim=-1).flatten(1)
+            return torch.cat([means.flatten(1), logvars.flatten(1), masks], dim=-1)
+        # sequences of per-expert tensors: a single concat of the pieces in the same layout
+        if self.block_structured:
+            return torch.cat(
+                [t for block in zip(means, logvars, (m.unsqueeze(-1) for m in masks)) for t in block], dim=-1
+            )
+        return torch.cat([*means, *logvars, *(m.unsqueeze(-1) for m in masks)], dim=-1)
+
+    @staticmethod
+    def _masked_weights(logits, mask):
+        """Softmax over the active experts; rows without any active expert get all-zero weights."""
+        active = mask != 0
+        any_active = active.any(dim=-1, keepdim=True)
+        # masked experts get exactly zero weight; fully masked rows are softmaxed over finite
+        # logits and zeroed afterwards so that neither the forward nor the backward sees NaN
+        logits = logits.masked_fill(~active & any_active, float("-inf"))
+        return logits.softmax(dim=-1) * any_active
 
     def forward(self, means, logvars, masks):
         """
         Args:
-            means (torch.Tensor): (batch_size, num_experts, latent_dim)
-            logvars (torch.Tensor): (batch_size, num_experts, latent_dim)
-            mask (torch.Tensor): (batch_size, num_experts), binary mask
+            means (torch.Tensor): (batch_size, num_experts, latent_dim), or a sequence of
+                num_experts tensors of shape (batch_size, latent_dim)
+            logvars (torch.Tensor): (batch_size, num_experts, latent_dim), or a sequence of
+                num_experts tensors of shape (batch_size, latent_dim)
+            mask (torch.Tensor): (batch_size, num_experts), binary mask, or a sequence of
+                num_experts tensors of shape (batch_size,)
 
         Returns:
             gating_weights (torch.Tensor): (batch_size, num_experts), normalized weights
         """
-        means = torch.stack(means, dim=1)
-        logvars = torch.stack(logvars, dim=1)
-        mask = torch.stack(masks, dim=1)
+        gating_input = self._gating_input(means, logvars, masks)  # (batch_size, input_dim)
+        autocast = (
+            torch.autocast(gating_input.device.type, dtype=torch.bfloat16)
+            if self.autocast_bf16
+            else contextlib.nullcontext()
+        )
+        if self.block_structured:
+            # [mean, logvar, mask] of each expert side by side, one conv group per expert
+            block_dim = 2 * self.latent_dim + 1
+            mask = gating_input[:, block_dim - 1::block_dim]  # (batch_size, num_experts)
+            with autocast:
+                logits = self.expert_fc(gating_input.unsqueeze(-1)).squeeze(-1)
+                logits = self.expert_mixing(logits)  # (batch_size, num_experts)
+            return self._masked_weights(logits.to(gating_input.dtype), mask)
+
+        num_experts = masks.shape[-1] if torch.is_tensor(masks) else len(masks)
+        mask = gating_input[:, -num_experts:]  # (batch_size, num_experts)
+
+        with autocast:
+            logits = self.fc(gating_input)  # (batch_size, num_experts)
+        logits = logits.to(gating_input.dtype)
+        gating_weights = self._masked_weights(logits, mask)  # Normalize weights across active experts
 
-        batch_size, num_experts, latent_dim = means.size()
-        means_flat = means.view(batch_size, -1)  # (batch_size, num_experts * latent_dim)
-        logvars_flat = logvars.view(batch_size, -1)  # (batch_size, num_experts * latent_dim)
-        mask_flat = mask.view(batch_size, -1)  # (batch_size, num_experts)
-        gating_input = torch.cat([means_flat, logvars_flat, mask_flat], dim=-1)  # (batch_size, input_dim)
+        return gating_weights
 
-        logits = self.fc(gating_input)  # (batch_size, num_experts)
-        gating_weights = F.softmax(logits, dim=-1)  # Normalize weights across experts
-        gating_weights = gating_weights * mask
-        gating_weights = gating_weights / (gating_weights.sum(dim=-1, keepdim=True) + 1e-8)
+def _bandwidth_multipliers(n_kernels, mul_factor):
+    exponents = torch.arange(n_kernels) - n_kernels // 2
+    if mul_factor == 2.0:
+        # exact powers of two from the exponent bits
+        return torch.ldexp(torch.ones(n_kernels), exponents)
+    return mul_factor ** exponents
 
-        return gating_weights
 
 class RBF(nn.Module):
     """
@@ -89,7 +147,9 @@ class RBF(nn.Module):
     """
     def __init__(self, n_kernels=5, mul_factor=2.0, bandwidth=None):
         super().__init__()
-        self.bandwidth_multipliers = mul_factor ** (torch.arange(n_kernels) - n_kernels // 2)
+        self.register_buffer(
+            "bandwidth_multipliers", _bandwidth_multipliers(n_kernels, mul_factor), persistent=False
+        )
         self.bandwidth = bandwidth
 
     def get_bandwidth(self, L2_distances):
@@ -99,23 +159,154 @@ class RBF(nn.Module):
 
         return self.bandwidth
 
+    @staticmethod
+    def _sq_distances(X, Y):
+        # squared distances from a single GEMM: |x|^2 + |y|^2 - 2 x.y
+        X_sq = X.pow(2).sum(dim=-1, keepdim=True)
+        Y_sq = X_sq if Y is X else Y.pow(2).sum(dim=-1, keepdim=True)
+        return (X_sq + Y_sq.T).addmm_(X, Y.T, alpha=-2).clamp_min_(0)
+
+    def _kernel(self, L2_distances, bandwidths, dtype=None):
+        # accumulate one kernel at a time instead of materializing (n_kernels, N, N)
+        K = torch.zeros_like(L2_distances, dtype=dtype)
+        for bandwidth in bandwidths:
+            K.add_(torch.exp(-L2_distances / bandwidth))
+        return K
+
     def forward(self, X):
-        L2_distances = torch.cdist(X, X) ** 2
-        return torch.exp(
-            -L2_distances[None, ...] / (self.get_bandwidth(L2_distances) * self.bandwidth_multipliers.to(L2_distances.device))[:, None, None]
-        ).sum(dim=0)
+        L2_distances = self._sq_distances(X, X)
+        bandwidths = self.get_bandwidth(L2_distances) * self.bandwidth_multipliers
+        return self._kernel(L2_distances, bandwidths)
+
+    def blocks(self, X, Y, distance_dtype=None):
+        """
+        Return the ``XX``, ``XY`` and ``YY`` blocks of the kernel matrix of the pooled samples.
+
+        Equivalent to slicing ``self(torch.vstack([X, Y]))``, but the ``YX`` block is never
+        computed since it is the transpose of ``XY``. If ``distance_dtype`` is given, the distances
+        are computed and reduced for the bandwidth in the input precision, but stored in
+        ``distance_dtype`` for the kernel evaluations; the kernels are still accumulated in the
+        input precision.
+        """
+        L2_XX = self._sq_distances(X, X)
+        L2_XY = self._sq_distances(X, Y)
+        L2_YY = self._sq_distances(Y, Y)
+        if self.bandwidth is None:
+            n_samples = X.shape[0] + Y.shape[0]
+            bandwidth = (L2_XX.data.sum() + 2 * L2_XY.data.sum() + L2_YY.data.sum()) / (n_samples ** 2 - n_samples)
+        else:
+            bandwidth = self.bandwidth
+        bandwidths = bandwidth * self.bandwidth_multipliers
+        L2_blocks = (L2_XX, L2_XY, L2_YY)
+        if distance_dtype is not None:
+            # the (n, n) distances are read once per bandwidth; halve those reads
+            L2_blocks = tuple(L2.to(distance_dtype) for L2 in L2_blocks)
+        return tuple(self._kernel(L2, bandwidths, dtype=X.dtype) for L2 in L2_blocks)
+
+
+class RandomFourierFeatures(nn.Module):
+    """
+    Random Fourier feature approximation of the multi-bandwidth :class:`RBF` kernel.
+
+    Embeds samples as ``sqrt(2 / D) * cos(x @ Omega + b)`` with one block of ``D`` features
+    per bandwidth multiplier, so that MMD becomes the distance between mean embeddings and
+    scales linearly instead of quadratically with the number of samples. ``Omega`` and ``b``
+    are drawn from a generator seeded with ``seed``, so the features do not depend on the
+    global RNG state and are the same after a checkpoint is reloaded.
+    """
+    def __init__(self, n_features=256, n_kernels=5, mul_factor=2.0, bandwidth=None, seed=0):
+        super().__init__()
+        self.n_features = n_features
+        self.seed = seed
+        self.register_buffer(
+            "bandwidth_multipliers", _bandwidth_multipliers(n_kernels, mul_factor), persistent=False
+        )
+        self.bandwidth = bandwidth
+        # sampled lazily once the input dimension is known
+        self.register_buffer("omega", None, persistent=False)
+        self.register_buffer("phase", None, persistent=False)
+
+    def _sample(self, X):
+        n_kernels = self.bandwidth_multipliers.shape[0]
+        shape = (n_kernels, X.shape[-1], self.n_features)
+        if self.omega is None or self.omega.shape != shape:
+            # drawn on the CPU so that the features are the same on every device
+            generator = torch.Generator().manual_seed(self.seed)
+            omega = torch.randn(shape, generator=generator)
+            phase = torch.rand(n_kernels, 1, self.n_features, generator=generator) * (2 * math.pi)
+            self.omega, self.phase = omega.to(X), phase.to(X)
+        elif self.omega.device != X.device or self.omega.dtype != X.dtype:
+            self.omega = self.omega.to(X)
+            self.phase = self.phase.to(X)
+
+    def get_bandwidth(self, X, Y):
+        if self.bandwidth is None:
+            # mean pairwise squared distance of the pooled samples in O(N d):
+            # sum_ij |z_i - z_j|^2 = 2 n sum_i |z_i|^2 - 2 |sum_i z_i|^2
+            X, Y = X.detach(), Y.detach()
+            n_samples = X.shape[0] + Y.shape[0]
+            sq_norms = X.pow(2).sum() + Y.pow(2).sum()
+            total = X.sum(dim=0) + Y.sum(dim=0)
+            return (2 * n_samples * sq_norms - 2 * total.pow(2).sum()) / (n_samples ** 2 - n_samples)
+
+        return self.bandwidth
+
+    def forward(self, X, Y):
+        """Return the mean feature embeddings of ``X`` and ``Y``, each of shape ``(n_kernels, D)``."""
+        self._sample(X)
+        bandwidths = self.get_bandwidth(X, Y) * self.bandwidth_multipliers
+        # exp(-|x - y|^2 / bandwidth) has spectral density N(0, 2 / bandwidth)
+        omega = self.omega * torch.sqrt(2 / bandwidths)[:, None, None]
+        scale = math.sqrt(2 / self.n_features)
+        X_emb = torch.cos(X @ omega + self.phase).mean(dim=-2) * scale
+        Y_emb = torch.cos(Y @ omega + self.phase).mean(dim=-2) * scale
+        return X_emb, Y_emb
 
 
 class MMDLoss(nn.Module):
     """
     From: https://github.com/yiftachbeer/mmd_loss_pytorch/blob/master/mmd_loss.py
+
+    If ``approx_kernel`` is given, it replaces ``kernel`` once both samples have more than
+    ``approx_threshold`` rows. With ``autocast_bf16``, the kernel runs under bfloat16 autocast
+    and the loss is returned in the input precision; the exact RBF distances are computed in
+    full precision and stored in bfloat16 for the kernel evaluations, which accumulate in full
+    precision.
     """
-    def __init__(self, kernel=RBF()):
+    def __init__(self, kernel=RBF(), approx_kernel=None, approx_threshold=256, autocast_bf16=False):
         super().__init__()
         self.kernel = kernel
+        self.approx_kernel = approx_kernel
+        self.approx_threshold = approx_threshold
+        self.autocast_bf16 = autocast_bf16
 
     def forward(self, X, Y):
-        K = self.kernel(torch.vstack([X, Y]))
+        if X.shape[0] < 2 or Y.shape[0] < 2:
+            return X.new_zeros(())
+        if not self.autocast_bf16:
+            return self._mmd(X, Y)
+
+        with torch.autocast(X.device.type, dtype=torch.bfloat16):
+            mmd = self._mmd(X, Y)
+        return mmd.to(X.dtype)
+
+    def _mmd(self, X, Y):
+        kernel = self.kernel
+        if self.approx_kernel is not None and min(X.shape[0], Y.shape[0]) > self.approx_threshold:
+            kernel = self.approx_kernel
+
+        if isinstance(kernel, RandomFourierFeatures):
+            X_emb, Y_emb = kernel(X, Y)
+            return (X_emb - Y_emb).pow(2).sum()
+        if isinstance(kernel, RBF):
+            K_XX, K_XY, K_YY = kernel.blocks(
+                X,
+                Y,
+                distance_dtype=torch.bfloat16 if self.autocast_bf16 else None,
+            )
+            return K_XX.mean() - 2 * K_XY.mean() + K_YY.mean()
+
+        K = kernel(torch.vstack([X, Y]))
 
         X_size = X.shape[0]
         XX = K[:X_size, :X_size].mean()
@@ -274,26 +465,28 @@ class DecoderADT(torch.nn.Module):
         py_ = {}
 
         py_back = self.py_back_decoder(z, *cat_list, cont_input=cont_input)
-        py_back_cat_z = torch.cat([py_back, z], dim=-1)
+        # the heads below take [h, z] as a pair so the concatenation is never materialized
+        py_back_cat_z = (py_back, z)
 
         py_["back_alpha"] = self.py_back_mean_log_alpha(py_back_cat_z, *cat_list, cont_input=cont_input)
         py_["back_beta"] = torch.exp(self.py_back_mean_log_beta(py_back_cat_z, *cat_list, cont_input=cont_input))
-        log_pro_back_mean = Normal(py_["back_alpha"], py_["back_beta"]).rsample()
+        # reparameterized sample alpha + beta * eps in one fused op, without building a Normal
+        log_pro_back_mean = torch.addcmul(py_["back_alpha"], py_["back_beta"], torch.randn_like(py_["back_alpha"]))
         py_["rate_back"] = torch.exp(log_pro_back_mean)
 
         py_fore = self.py_fore_decoder(z, *cat_list, cont_input=cont_input)
-        py_fore_cat_z = torch.cat([py_fore, z], dim=-1)
+        py_fore_cat_z = (py_fore, z)
         py_["fore_scale"] = self.py_fore_scale_decoder(py_fore_cat_z, *cat_list, cont_input=cont_input) + 1 + 1e-8
         py_["rate_fore"] = py_["rate_back"] * py_["fore_scale"]
 
         p_mixing = self.sigmoid_decoder(z, *cat_list, cont_input=cont_input)
-        p_mixing_cat_z = torch.cat([p_mixing, z], dim=-1)
+        p_mixing_cat_z = (p_mixing, z)
         py_["mixing"] = self.py_background_decoder(p_mixing_cat_z, *cat_list, cont_input=cont_input)
 
-        protein_mixing = 1 / (1 + torch.exp(-py_["mixing"]))
-        py_["scale"] = torch.nn.functional.normalize(
-            (1 - protein_mixing) * py_["rate_fore"], p=1, dim=-1
-        )
+        protein_mixing = torch.sigmoid(py_["mixing"])
+        # L1 normalization; the entries are positive so the norm is a plain sum
+        scale = (1 - protein_mixing) * py_["rate_fore"]
+        py_["scale"] = scale / scale.sum(dim=-1, keepdim=True).clamp_min(1e-12)
 
         return py_, log_pro_back_mean
 
@@ -331,7 +524,11 @@ class NETWORKVAE(BaseModuleClass):
         Training Penalty across modalities. One of the following:
         * ``"Jeffreys"``: Jeffreys penalty to align modalities
         * ``"MMD"``: MMD penalty to align modalities
+        * ``"realMMD"``: Kernel MMD penalty between the paired latent means
+        * ``"RF"``: Normalizing-flow penalty, bimodal data only
         * ``"None"``: No penalty
+    alpha_rf
+        Weight of the flow penalty for ``modality_penalty="RF"``; ``0`` skips the flows.
     n_hidden
         Number of nodes per hidden layer. If `None`, defaults to square root
         of number of regions.
@@ -387,6 +584,20 @@ class NETWORKVAE(BaseModuleClass):
         Bool, whether perform modality mixing with PoE.
     use_mixture_of_experts
         Bool, whether perform modality mixing with MoE.
+    block_gating
+        Bool, whether the MoE gating network scores each modality from its own posterior
+        only, see ``block_structured`` in :class:`GatingNetwork`.
+    bf16_submodules
+        Bool, whether to run the MoE gating network and the MMD penalty under bfloat16
+        autocast, and to evaluate the Jeffreys and MMD modality penalties in bfloat16 with
+        full-precision accumulation.
+    compile_submodules
+        Bool, whether to compile the MoE gating network, the MMD penalties, the Jeffreys penalty,
+        the modality mixing and the expression/accessibility reconstruction losses with
+        :func:`torch.compile`.
+    compile_forward
+        Bool, whether to compile the ``inference`` and ``generative`` methods as a whole with
+        :func:`torch.compile`.
     dropout_rate
         Dropout rate for neural networks.
     model_depth
@@ -430,7 +641,8 @@ class NETWORKVAE(BaseModuleClass):
         ensembl_ids_proteins: np.ndarray | None = None,
         n_patient_covariates: int = 0,
         modality_weights: Literal["equal", "cell", "universal", "moe"] = "equal",
-        modality_penalty: Literal["Jeffreys", "MMD", "None"] = "Jeffreys",
+        modality_penalty: Literal["Jeffreys", "MMD", "realMMD", "RF", "None"] = "Jeffreys",
+        alpha_rf: float = 0.1,
         n_batch: int = 0,
         n_obs: int = 0,
         n_labels: int = 0,
@@ -481,6 +693,10 @@ class NETWORKVAE(BaseModuleClass):
         use_mean_mixing: bool = False,
         use_product_of_experts: bool = False,
         use_mixture_of_experts: bool = True,
+        block_gating: bool = False,
+        bf16_submodules: bool = False,
+        compile_submodules: bool = False,
+        compile_forward: bool = False,
         **kwargs,
     ):
         super().__init__()
@@ -537,21 +753,23 @@ class NETWORKVAE(BaseModuleClass):
         self.last_layer_inject_covariates = last_layer_inject_covariates
         self.use_size_factor_key = use_size_factor_key
 
-        cat_list = [n_batch] + (list(n_cats_per_cov) if n_cats_per_cov is not None else []) + ([n_continuous_cov] if n_continuous_cov is not None and n_continuous_cov != 0 else [])
-        cat_list_encoder = [n_batch] + (list(n_cats_per_cov) if n_cats_per_cov is not None else []) + ([n_continuous_cov] if n_continuous_cov is not None and n_continuous_cov != 0 else [])
-        encoder_cat_list_library = cat_list if encode_covariates else None
-        encoder_cat_list = cat_list_encoder if encode_covariates else None
+        # one immutable covariate layout shared by all encoders and decoders
+        cat_list = tuple(
+            [n_batch]
+            + (list(n_cats_per_cov) if n_cats_per_cov is not None else [])
+            + ([n_continuous_cov] if n_continuous_cov is not None and n_continuous_cov != 0 else [])
+        )
+        encoder_cat_list = cat_list if encode_covariates else None
 
         # expression
         # expression dispersion parameters
-        self.gene_likelihood = gene_likelihood
         self.gene_dispersion = gene_dispersion
         if self.gene_dispersion == "gene":
-            self.px_r = torch.nn.Parameter(torch.randn(n_input_genes))
+            self.px_r = torch.nn.Parameter(nn.init.normal_(torch.empty(n_input_genes)))
         elif self.gene_dispersion == "gene-batch":
-            self.px_r = torch.nn.Parameter(torch.randn(n_input_genes, n_batch))
+            self.px_r = torch.nn.Parameter(nn.init.normal_(torch.empty(n_input_genes, n_batch)))
         elif self.gene_dispersion == "gene-label":
-            self.px_r = torch.nn.Parameter(torch.randn(n_input_genes, n_labels))
+            self.px_r = torch.nn.Parameter(nn.init.normal_(torch.empty(n_input_genes, n_labels)))
         elif self.gene_dispersion == "gene-cell":
             pass
         else:
@@ -628,7 +846,7 @@ class NETWORKVAE(BaseModuleClass):
         self.l_encoder_expression = LibrarySizeEncoder(
             n_input_encoder_exp,
             #n_input_encoder_exp + n_continuous_cov * encode_covariates,
-            n_cat_list=encoder_cat_list_library,
+            n_cat_list=encoder_cat_list,
             n_layers=self.n_layers_encoder,
             n_hidden=self.n_hidden,
             use_batch_norm=self.use_batch_norm_encoder,
@@ -744,7 +962,7 @@ class NETWORKVAE(BaseModuleClass):
             #n_input=n_input_encoder_acc + n_continuous_cov * encode_covariates,
             n_output=1,
             n_hidden=self.n_hidden,
-            n_cat_list=encoder_cat_list_library,
+            n_cat_list=encoder_cat_list,
             n_layers=self.n_layers_encoder,
             use_batch_norm=self.use_batch_norm_encoder,
             use_layer_norm=self.use_layer_norm_encoder,
@@ -765,15 +983,15 @@ class NETWORKVAE(BaseModuleClass):
         if protein_background_prior_mean is None:
             if n_batch > 0:
                 self.background_pro_alpha = torch.nn.Parameter(
-                    torch.randn(n_input_proteins, n_batch)
+                    nn.init.normal_(torch.empty(n_input_proteins, n_batch))
                 )
                 self.background_pro_log_beta = torch.nn.Parameter(
-                    torch.clamp(torch.randn(n_input_proteins, n_batch), -10, 1)
+                    nn.init.normal_(torch.empty(n_input_proteins, n_batch)).clamp_(-10, 1)
                 )
             else:
-                self.background_pro_alpha = torch.nn.Parameter(torch.randn(n_input_proteins))
+                self.background_pro_alpha = torch.nn.Parameter(nn.init.normal_(torch.empty(n_input_proteins)))
                 self.background_pro_log_beta = torch.nn.Parameter(
-                    torch.clamp(torch.randn(n_input_proteins), -10, 1)
+                    nn.init.normal_(torch.empty(n_input_proteins)).clamp_(-10, 1)
                 )
         else:
             if protein_background_prior_mean.shape[1] == 1 and n_batch != 1:
@@ -786,7 +1004,7 @@ class NETWORKVAE(BaseModuleClass):
                 torch.from_numpy(init_mean.astype(np.float32))
             )
             self.background_pro_log_beta = torch.nn.Parameter(
-                torch.log(torch.from_numpy(init_scale.astype(np.float32)))
+                torch.from_numpy(np.log(init_scale, dtype=np.float32))
             )
 
         # protein encoder
@@ -857,11 +1075,11 @@ class NETWORKVAE(BaseModuleClass):
 
         # protein dispersion parameters
         if self.protein_dispersion == "protein":
-            self.py_r = torch.nn.Parameter(2 * torch.rand(self.n_input_proteins))
+            self.py_r = torch.nn.Parameter(nn.init.uniform_(torch.empty(self.n_input_proteins), 0, 2))
         elif self.protein_dispersion == "protein-batch":
-            self.py_r = torch.nn.Parameter(2 * torch.rand(self.n_input_proteins, n_batch))
+            self.py_r = torch.nn.Parameter(nn.init.uniform_(torch.empty(self.n_input_proteins, n_batch), 0, 2))
         elif self.protein_dispersion == "protein-label":
-            self.py_r = torch.nn.Parameter(2 * torch.rand(self.n_input_proteins, n_labels))
+            self.py_r = torch.nn.Parameter(nn.init.uniform_(torch.empty(self.n_input_proteins, n_labels), 0, 2))
         else:  # protein-cell
             pass
 
@@ -869,6 +1087,16 @@ class NETWORKVAE(BaseModuleClass):
         self.n_obs = n_obs
         self.modality_weights = modality_weights
         self.modality_penalty = modality_penalty
+        self.alpha_rf = alpha_rf
+        # normalizing flows of the "RF" penalty; there is no flow implementation yet, so the
+        # penalty is zero until they are set
+        self.flow_top_to_bottom = None
+        self.flow_bottom_to_top = None
+        self.bf16_submodules = bf16_submodules
+        if modality_penalty == "realMMD":
+            self.mmd_loss = MMDLoss(
+                kernel=RBF(), approx_kernel=RandomFourierFeatures(), autocast_bf16=bf16_submodules
+            )
         self.n_modalities = int(n_input_genes > 0) + int(n_input_regions > 0)
         max_n_modalities = 4
         if modality_weights == "equal":
@@ -877,10 +1105,38 @@ class NETWORKVAE(BaseModuleClass):
         elif modality_weights == "universal":
             self.mod_weights = torch.nn.Parameter(torch.ones(max_n_modalities))
         elif modality_weights == "moe":
-            self.gating_network = GatingNetwork(latent_dim=self.n_latent, num_experts=3)
+            self.gating_network = GatingNetwork(
+                latent_dim=self.n_latent,
+                num_experts=3,
+                block_structured=block_gating,
+                autocast_bf16=bf16_submodules,
+            )
         else:  # cell-specific weights
             self.mod_weights = torch.nn.Parameter(torch.ones(n_obs, max_n_modalities))
 
+        if compile_submodules:
+            # compiled in place so the state_dict keys do not change; the number of cells
+            # per modality pair varies between minibatches, hence dynamic shapes
+            for name in ("gating_network", "mmd_loss"):
+                if hasattr(self, name):
+                    getattr(self, name).compile(dynamic=True)
+            # pointwise/reduction chains run once per minibatch; fused as instance attributes
+            for name in (
+                "mix_modalities_poe",
+                "mix_modalities_moe",
+                "mix_modalities",
+                "get_reconstruction_loss_expression",
+                "get_reconstruction_loss_accessibility",
+                "_jeffreys_pair_penalty",
+                "_mmd_pair_penalty",
+            ):
+                setattr(self, name, torch.compile(getattr(self, name), dynamic=True))
+        if compile_forward:
+            # fuses the pointwise tails around the encoders/decoders; the modality branches
+            # are fixed at construction, so each compiled graph only specializes once
+            for name in ("inference", "generative"):
+                setattr(self, name, torch.compile(getattr(self, name), dynamic=True))
+
     def _get_inference_input(self, tensors):
         """Get input tensors for the inference model."""
         x = tensors[REGISTRY_KEYS.X_KEY]
@@ -906,6 +1162,25 @@ class NETWORKVAE(BaseModuleClass):
         }
         return input_dict
 
+    def _categorical_input(self, cat_covs):
+        """Split ``cat_covs`` into one one-hot encoded tensor per covariate.
+
+        All encoders and decoders share ``cat_list``, so encoding the columns once here spares
+        every :class:`~networkvi.nn.FCLayers` from re-encoding and range-checking them.
+        """
+        if cat_covs is None:
+            return ()
+        categorical_input = []
+        for cat, n_cat in zip(torch.split(cat_covs, 1, dim=1), self.n_cats_per_cov or ()):
+            if n_cat > 1:
+                cat = cat.squeeze(-1).long()
+                # same as FCLayers: covariates with unseen categories are zeroed out; the range
+                # check stays on the device so that it does not force a sync
+                one_hot = cat.unsqueeze(-1) == torch.arange(n_cat, device=cat.device)
+                cat = one_hot.long() * (cat < n_cat).all()
+            categorical_input.append(cat)
+        return tuple(categorical_input)
+
     @auto_move_data
     def mix_modalities_poe(self, mus, vars, masks): #, weights, weight_transform: callable = None, mode=None):
         """Compute the PoE of the Xs while masking unmeasured modality values.
@@ -919,14 +1194,15 @@ class NETWORKVAE(BaseModuleClass):
             should be included in the mix or not (N)
         """
 
-        mus = torch.stack(mus, dim=1)
-        vars = torch.stack(vars, dim=1)
-        masks = torch.stack(masks, dim=1).float().unsqueeze(-1)
-        mus_joint = torch.sum(mus * masks / vars, dim=1)
-        vars_joint = torch.ones_like(mus_joint)
-        vars_joint += torch.sum(masks / vars, dim=1)
-        vars_joint = 1.0 / vars_joint
-        mus_joint *= vars_joint
+        # accumulate the precision-weighted sums modality by modality instead of stacking
+        precision = 1.0  # standard normal prior expert
+        weighted_mus = 0.0
+        for mu, var, mask in zip(mus, vars, masks):
+            masked_precision = mask.unsqueeze(-1) / var
+            precision = precision + masked_precision
+            weighted_mus = weighted_mus + masked_precision * mu
+        vars_joint = precision.reciprocal()
+        mus_joint = weighted_mus * vars_joint
 
         return mus_joint, vars_joint
 
@@ -943,15 +1219,23 @@ class NETWORKVAE(BaseModuleClass):
             should be included in the mix or not (N)
         """
 
-        mus = torch.stack(mus, dim=1)
-        vars = torch.stack(vars, dim=1)
-        masks = torch.stack(masks, dim=1).float().unsqueeze(-1)
+        # accumulate the weighted sums modality by modality instead of stacking
         if weights is None:
-            weights = masks / torch.sum(masks, dim=1, keepdim=True)
+            masks = [mask.float().unsqueeze(-1) for mask in masks]
+            n_measured = sum(masks)
+            weights = [mask / n_measured for mask in masks]
         else:
-            weights = weights.unsqueeze(axis=-1)
-        mus_mixture = torch.sum(weights * mus, dim=1)
-        vars_mixture = torch.sum(weights**2 * vars, dim=1)
+            if weights.shape[-1] != len(mus):
+                raise ValueError(
+                    f"Expected one MoE weight per modality ({len(mus)}), but got "
+                    f"{weights.shape[-1]}."
+                )
+            weights = weights.unsqueeze(-1).unbind(dim=1)
+        mus_mixture = 0.0
+        vars_mixture = 0.0
+        for mu, var, weight in zip(mus, vars, weights):
+            mus_mixture = mus_mixture + weight * mu
+            vars_mixture = vars_mixture + weight**2 * var
 
         return mus_mixture, vars_mixture
 
@@ -963,10 +1247,10 @@ class NETWORKVAE(BaseModuleClass):
         Parameters
         ----------
         Xs
-            Sequence of Xs to mix, each should be (N x D)
+            Sequence of Xs to mix, each should be (N x D), or the already stacked (N x K x D)
         masks
             Sequence of masks corresponding to the Xs, indicating whether the values
-            should be included in the mix or not (N)
+            should be included in the mix or not (N), or the already stacked (N x K)
         weights
             Weights for each modality (either K or N x K)
         weight_transform
@@ -974,9 +1258,11 @@ class NETWORKVAE(BaseModuleClass):
         """
 
         # (batch_size x latent) -> (batch_size x modalities x latent)
-        Xs = torch.stack(Xs, dim=1)
+        if not torch.is_tensor(Xs):
+            Xs = torch.stack(Xs, dim=1)
         # (batch_size) -> (batch_size x modalities)
-        masks = torch.stack(masks, dim=1).float()
+        if not torch.is_tensor(masks):
+            masks = torch.stack(masks, dim=1).float()
         weights = masked_softmax(weights, masks, dim=-1)
 
         # (batch_size x modalities) -> (batch_size x modalities x latent)
@@ -1015,22 +1301,8 @@ class NETWORKVAE(BaseModuleClass):
         mask_acc = x_chr.sum(dim=1) > 0
         mask_pro = y.sum(dim=1) > 0
 
-        encoder_input_expression = x_rna
-        encoder_input_accessibility = x_chr
-        encoder_input_protein = y
-        """
-        if cont_covs is not None and self.encode_covariates:
-            encoder_input_expression = torch.cat((x_rna, cont_covs), dim=-1)
-            encoder_input_accessibility = torch.cat((x_chr, cont_covs), dim=-1)
-            encoder_input_protein = torch.cat((y, cont_covs), dim=-1)
-        else:
-            encoder_input_expression = x_rna
-            encoder_input_accessibility = x_chr
-            encoder_input_protein = y
-        """
-
         if cat_covs is not None and self.encode_covariates:
-            categorical_input = torch.split(cat_covs, 1, dim=1)
+            categorical_input = self._categorical_input(cat_covs)
         else:
             categorical_input = ()
         if cont_covs is not None and self.encode_covariates:
@@ -1040,22 +1312,22 @@ class NETWORKVAE(BaseModuleClass):
 
         # Z Encoders
         qzm_acc, qzv_acc, z_acc = self.z_encoder_accessibility(
-            encoder_input_accessibility, batch_index, *categorical_input, cont_input=continuous_input
+            x_chr, batch_index, *categorical_input, cont_input=continuous_input
         )
         qzm_expr, qzv_expr, z_expr = self.z_encoder_expression(
-            encoder_input_expression, batch_index, *categorical_input, cont_input=continuous_input
+            x_rna, batch_index, *categorical_input, cont_input=continuous_input
         )
         qzm_pro, qzv_pro, z_pro = self.z_encoder_protein(
-            encoder_input_protein, batch_index, *categorical_input, cont_input=continuous_input
+            y, batch_index, *categorical_input, cont_input=continuous_input
         )
 
         # L encoders
         libsize_expr = self.l_encoder_expression(
-            encoder_input_expression, batch_index, *categorical_input, cont_input=continuous_input
-        ) #encoder_input_expression
+            x_rna, batch_index, *categorical_input, cont_input=continuous_input
+        )
         libsize_acc = self.l_encoder_accessibility(
-            encoder_input_accessibility, batch_index, *categorical_input, cont_input=continuous_input
-        ) #encoder_input_accessibility
+            x_chr, batch_index, *categorical_input, cont_input=continuous_input
+        )
 
 
         if self.modality_weights == "cell":
@@ -1075,13 +1347,14 @@ class NETWORKVAE(BaseModuleClass):
 
             untran_z = Normal(qz_m, qz_v.sqrt()).rsample()
         elif self.use_mean_mixing:
-
+            # stacked once, shared by the mean and the variance mix
+            masks = torch.stack((mask_expr, mask_acc, mask_pro), dim=1).float()
             qz_m = self.mix_modalities(
-                (qzm_expr, qzm_acc, qzm_pro), (mask_expr, mask_acc, mask_pro), weights, mode="mean"
+                (qzm_expr, qzm_acc, qzm_pro), masks, weights, mode="mean"
             )
             qz_v = self.mix_modalities(
                 (qzv_expr, qzv_acc, qzv_pro),
-                (mask_expr, mask_acc, mask_pro),
+                masks,
                 weights,
                 torch.sqrt,
                 mode="variance"
@@ -1113,8 +1386,8 @@ class NETWORKVAE(BaseModuleClass):
         outputs = {
             "untran_z": untran_z,
             "z": z,
-            "qz_m": qz_m if 'qz_m' in locals() else None,
-            "qz_v": qz_v if 'qz_v' in locals() else None,
+            "qz_m": qz_m,
+            "qz_v": qz_v,
             "z_expr": z_expr,
             "qzm_expr": qzm_expr,
             "qzv_expr": qzv_expr,
@@ -1126,6 +1399,11 @@ class NETWORKVAE(BaseModuleClass):
             "qzv_pro": qzv_pro,
             "libsize_expr": libsize_expr,
             "libsize_acc": libsize_acc,
+            "x_chr": x_chr,
+            "y": y,
+            "mask_expr": mask_expr,
+            "mask_acc": mask_acc,
+            "mask_pro": mask_pro,
         }
         return outputs
 
@@ -1136,8 +1414,11 @@ class NETWORKVAE(BaseModuleClass):
         libsize_expr = inference_outputs["libsize_expr"]
 
         size_factor_key = REGISTRY_KEYS.SIZE_FACTOR_KEY
+        # generative only reads the size factor when use_size_factor_key is set
         size_factor = (
-            torch.log(tensors[size_factor_key]) if size_factor_key in tensors.keys() else None
+            torch.log(tensors[size_factor_key])
+            if self.use_size_factor_key and size_factor_key in tensors.keys()
+            else None
         )
 
         batch_index = tensors[REGISTRY_KEYS.BATCH_KEY]
@@ -1149,7 +1430,7 @@ class NETWORKVAE(BaseModuleClass):
         cat_covs = tensors[cat_key] if cat_key in tensors.keys() else None
 
         if transform_batch is not None:
-            batch_index = torch.ones_like(batch_index) * transform_batch
+            batch_index = batch_index.new_full(batch_index.shape, transform_batch)
 
         label = tensors[REGISTRY_KEYS.LABELS_KEY]
 
@@ -1181,10 +1462,7 @@ class NETWORKVAE(BaseModuleClass):
         label: torch.Tensor = None,
     ):
         """Runs the generative model."""
-        if cat_covs is not None:
-            categorical_input = torch.split(cat_covs, 1, dim=1)
-        else:
-            categorical_input = ()
+        categorical_input = self._categorical_input(cat_covs)
 
         latent = z if not use_z_mean else qz_m
         """
@@ -1218,35 +1496,33 @@ class NETWORKVAE(BaseModuleClass):
             #label,
             cont_input=continuous_input
         )
-        # Expression Dispersion
+        # Expression Dispersion; exponentiated on the parameter table before the per-cell
+        # gather, so the exp runs per category rather than per cell
         if self.gene_dispersion == "gene-label":
-            px_r = F.linear(
-                F.one_hot(label.squeeze(-1), self.n_labels).float(), self.px_r
-            )  # px_r gets transposed - last dimension is nb genes
+            # row gather instead of a one-hot GEMM - last dimension is nb genes
+            px_r = torch.exp(self.px_r).T[label.squeeze(-1)]
         elif self.gene_dispersion == "gene-batch":
-            px_r = F.linear(F.one_hot(batch_index.squeeze(-1), self.n_batch).float(), self.px_r)
+            px_r = torch.exp(self.px_r).T[batch_index.squeeze(-1)]
         elif self.gene_dispersion == "gene":
-            px_r = self.px_r
-        px_r = torch.exp(px_r)
+            px_r = torch.exp(self.px_r)
 
         # Protein Decoder
         py_, log_pro_back_mean = self.z_decoder_pro(decoder_input, batch_index, *categorical_input, cont_input=continuous_input)
         # Protein Dispersion
         if self.protein_dispersion == "protein-label":
-            # py_r gets transposed - last dimension is n_proteins
-            py_r = F.linear(F.one_hot(label.squeeze(-1), self.n_labels).float(), self.py_r)
+            # row gather instead of a one-hot GEMM - last dimension is n_proteins
+            py_r = torch.exp(self.py_r).T[label.squeeze(-1)]
         elif self.protein_dispersion == "protein-batch":
-            py_r = F.linear(F.one_hot(batch_index.squeeze(-1), self.n_batch).float(), self.py_r)
+            py_r = torch.exp(self.py_r).T[batch_index.squeeze(-1)]
         elif self.protein_dispersion == "protein":
-            py_r = self.py_r
-        py_r = torch.exp(py_r)
+            py_r = torch.exp(self.py_r)
         py_["r"] = py_r
 
         return {
             "p": p,
             "patient_index": patient_index,
             "px_scale": px_scale,
-            "px_r": torch.exp(self.px_r),
+            "px_r": px_r,
             "px_rate": px_rate,
             "px_dropout": px_dropout,
             "py_": py_,
@@ -1255,21 +1531,18 @@ class NETWORKVAE(BaseModuleClass):
 
     def loss(self, tensors, inference_outputs, generative_outputs, kl_weight: float = 1.0):
         """Computes the loss function for the model."""
-        # Get the data
+        # Get the data; the modality slices and masks were already computed by inference
         x = tensors[REGISTRY_KEYS.X_KEY]
-
         x_rna = x[:, : self.n_input_genes]
-        x_chr = x[:, self.n_input_genes : (self.n_input_genes + self.n_input_regions)]
-        if self.n_input_proteins == 0:
-            y = torch.zeros(x.shape[0], 1, device=x.device, requires_grad=False)
-        else:
-            y = tensors[REGISTRY_KEYS.PROTEIN_EXP_KEY]
-
-        mask_expr = x_rna.sum(dim=1) > 0
-        mask_acc = x_chr.sum(dim=1) > 0
-        mask_pro = y.sum(dim=1) > 0
-
-        if mask_acc.sum().gt(0):
+        x_chr = inference_outputs["x_chr"]
+        y = inference_outputs["y"]
+        mask_expr = inference_outputs["mask_expr"]
+        mask_acc = inference_outputs["mask_acc"]
+        mask_pro = inference_outputs["mask_pro"]
+
+        # the per-cell losses are masked below, so the modality only has to be skipped when
+        # it is absent from the model; checking the minibatch masks here would sync the device
+        if self.n_input_regions > 0:
             # Compute Accessibility loss
             p = generative_outputs["p"]
             libsize_acc = inference_outputs["libsize_acc"]
@@ -1281,13 +1554,12 @@ class NETWORKVAE(BaseModuleClass):
         px_rate = generative_outputs["px_rate"]
         px_r = generative_outputs["px_r"]
         px_dropout = generative_outputs["px_dropout"]
-        x_expression = x[:, : self.n_input_genes]
         rl_expression = self.get_reconstruction_loss_expression(
-            x_expression, px_rate, px_r, px_dropout
+            x_rna, px_rate, px_r, px_dropout
         )
 
         # Compute Protein loss - No ability to mask minibatch (Param:None)
-        if mask_pro.sum().gt(0):
+        if self.n_input_proteins > 0:
             py_ = generative_outputs["py_"]
             rl_protein = get_reconstruction_loss_protein(y, py_, None)
         else:
@@ -1308,10 +1580,8 @@ class NETWORKVAE(BaseModuleClass):
         else:
             qz_m = inference_outputs["qz_m"]
             qz_v = inference_outputs["qz_v"]
-            kl_div_z = kld(
-                Normal(qz_m, torch.sqrt(qz_v)),
-                Normal(0, 1),
-            ).sum(dim=1)
+            # closed form of KL(N(qz_m, qz_v) || N(0, I))
+            kl_div_z = 0.5 * (qz_v + qz_m.pow(2) - 1.0 - qz_v.log()).sum(dim=1)
 
         # Compute KLD between distributions for paired data
         kl_div_paired = self._compute_mod_penalty(
@@ -1360,7 +1630,54 @@ class NETWORKVAE(BaseModuleClass):
     def get_reconstruction_loss_accessibility(self, x, p, d):
         """Computes the reconstruction loss for the accessibility data."""
         reg_factor = torch.sigmoid(self.region_factors) if self.region_factors is not None else 1
-        return torch.nn.BCELoss(reduction="none")(p * d * reg_factor, (x > 0).float()).sum(dim=-1)
+        p_obs = p * d * reg_factor
+        return F.binary_cross_entropy(p_obs, (x > 0).to(p_obs.dtype), reduction="none").sum(dim=-1)
+
+    @staticmethod
+    def _jeffreys_pair_penalty(mod_params1, mod_params2, mod_params3, pair_masks, compute_dtype=None):
+        """Per-cell symmetric KL summed over the modality pairs 12, 13 and 23 measured in ``pair_masks``.
+
+        If given, the KL is evaluated in ``compute_dtype`` and accumulated in the input precision.
+        """
+        # all three pairs in one batched call: (pairs x batch_size x latent); cells lacking
+        # one of the modalities of a pair are dropped by the where against a scalar zero
+        pairs = (
+            torch.stack((mod_params1[0], mod_params1[0], mod_params2[0])),
+            torch.stack((mod_params1[1], mod_params1[1], mod_params2[1])).sqrt(),
+            torch.stack((mod_params2[0], mod_params3[0], mod_params3[0])),
+            torch.stack((mod_params2[1], mod_params3[1], mod_params3[1])).sqrt(),
+        )
+        if compute_dtype is not None:
+            # the z encoders add no variance floor; keep the variance ratios bounded when rounded
+            means1, vars1, means2, vars2 = (t.to(compute_dtype) for t in pairs)
+            pairs = (means1, vars1.clamp_min(1e-6), means2, vars2.clamp_min(1e-6))
+        penalties = sym_kld(*pairs)
+        return torch.where(pair_masks.unsqueeze(-1), penalties, 0.0).sum(
+            dim=(0, 2), dtype=mod_params1[0].dtype
+        )
+
+    @staticmethod
+    def _mmd_pair_penalty(mod_params1, mod_params2, mod_params3, pair_masks, compute_dtype=None):
+        """Latent-mean distances summed over all cells and modality pairs measured in ``pair_masks``.
+
+        If given, the distances are evaluated in ``compute_dtype`` and accumulated in the input
+        precision.
+        """
+        # (pairs x batch_size) distances
+        diffs = torch.stack((mod_params1[0], mod_params1[0], mod_params2[0])) - torch.stack(
+            (mod_params2[0], mod_params3[0], mod_params3[0])
+        )
+        if compute_dtype is not None:
+            diffs = diffs.to(compute_dtype)
+        penalties = torch.linalg.norm(diffs, dim=-1)
+        return torch.where(pair_masks, penalties, 0.0).sum(dtype=mod_params1[0].dtype)
+
+    @staticmethod
+    def _sum_pair_penalties(penalties, mask):
+        """Sum the penalties of the measured modality pairs, broadcast over the cells of ``mask``."""
+        if not penalties:
+            return torch.zeros(mask.shape[0], device=mask.device)
+        return torch.stack(penalties).sum(dim=0).expand(mask.shape[0])
 
     def _compute_mod_penalty(self, mod_params1, mod_params2, mod_params3, mask1, mask2, mask3, patient_index):
         """Computes Similarity Penalty across modalities given selection (None, Jeffreys, MMD).
@@ -1375,99 +1692,72 @@ class NETWORKVAE(BaseModuleClass):
         mask12 = torch.logical_and(mask1, mask2)
         mask13 = torch.logical_and(mask1, mask3)
         mask23 = torch.logical_and(mask3, mask2)
+        penalty_dtype = torch.bfloat16 if self.bf16_submodules else None
 
         if self.modality_penalty == "None":
-            pair_penalty = torch.tensor([0.0]*mask1.shape[0], device=mask1.device, requires_grad=True)
+            pair_penalty = torch.zeros(mask1.shape[0], device=mask1.device)
         elif self.modality_penalty == "Jeffreys":
-            pair_penalty = torch.zeros(mask1.shape[0], device=mask1.device, requires_grad=True)
-            if mask12.sum().gt(0):
-                penalty12 = sym_kld(
-                    mod_params1[0],
-                    mod_params1[1].sqrt(),
-                    mod_params2[0],
-                    mod_params2[1].sqrt(),
-                )
-                penalty12 = torch.where(mask12, penalty12.T, torch.zeros_like(penalty12).T).sum(
-                    dim=0
-                )
-                pair_penalty = pair_penalty + penalty12
-            if mask13.sum().gt(0):
-                penalty13 = sym_kld(
-                    mod_params1[0],
-                    mod_params1[1].sqrt(),
-                    mod_params3[0],
-                    mod_params3[1].sqrt(),
-                )
-                penalty13 = torch.where(mask13, penalty13.T, torch.zeros_like(penalty13).T).sum(
-                    dim=0
-                )
-                pair_penalty = pair_penalty + penalty13
-            if mask23.sum().gt(0):
-                penalty23 = sym_kld(
-                    mod_params2[0],
-                    mod_params2[1].sqrt(),
-                    mod_params3[0],
-                    mod_params3[1].sqrt(),
-                )
-                penalty23 = torch.where(mask23, penalty23.T, torch.zeros_like(penalty23).T).sum(
-                    dim=0
-                )
-                pair_penalty = pair_penalty + penalty23
+            pair_masks = torch.stack((mask12, mask13, mask23))
+            pair_penalty = self._jeffreys_pair_penalty(
+                mod_params1, mod_params2, mod_params3, pair_masks, compute_dtype=penalty_dtype
+            )
 
         elif self.modality_penalty == "MMD":
-            pair_penalty = torch.zeros(mask1.shape[0], device=mask1.device, requires_grad=True)
-            if mask12.sum().gt(0):
-                penalty12 = torch.linalg.norm(mod_params1[0] - mod_params2[0], dim=1)
-                penalty12 = torch.where(mask12, penalty12.T, torch.zeros_like(penalty12).T).sum(
-                    dim=0
-                )
-                pair_penalty = pair_penalty + penalty12
-            if mask13.sum().gt(0):
-                penalty13 = torch.linalg.norm(mod_params1[0] - mod_params3[0], dim=1)
-                penalty13 = torch.where(mask13, penalty13.T, torch.zeros_like(penalty13).T).sum(
-                    dim=0
-                )
-                pair_penalty = pair_penalty + penalty13
-            if mask23.sum().gt(0):
-                penalty23 = torch.linalg.norm(mod_params2[0] - mod_params3[0], dim=1)
-                penalty23 = torch.where(mask23, penalty23.T, torch.zeros_like(penalty23).T).sum(
-                    dim=0
-                )
-                pair_penalty = pair_penalty + penalty23
+            pair_masks = torch.stack((mask12, mask13, mask23))
+            pair_penalty = self._mmd_pair_penalty(
+                mod_params1, mod_params2, mod_params3, pair_masks, compute_dtype=penalty_dtype
+            ).expand(mask1.shape[0])
 
         elif self.modality_penalty == "realMMD":
-            mmd_loss = MMDLoss()
+            mmd_loss = self.mmd_loss
 
-            pair_penalty = torch.zeros(mask1.shape[0], device=mask1.device, requires_grad=True)
+            # presence of all three pairs in a single device-to-host transfer
+            has12, has13, has23 = torch.stack((mask12, mask13, mask23)).any(dim=1).tolist()
+            penalties = []
 
-            if mask12.sum().gt(0):
-                penalty12 = mmd_loss(mod_params1[0][mask12], mod_params2[0][mask12])
-                pair_penalty = pair_penalty + penalty12
+            if has12:
+                idx12 = mask12.nonzero(as_tuple=True)[0]
+                penalty12 = mmd_loss(mod_params1[0].index_select(0, idx12), mod_params2[0].index_select(0, idx12))
+                penalties.append(penalty12)
 
-            if mask13.sum().gt(0):
-                penalty13 = mmd_loss(mod_params1[0][mask13], mod_params3[0][mask13])
-                pair_penalty = pair_penalty + penalty13
+            if has13:
+                idx13 = mask13.nonzero(as_tuple=True)[0]
+                penalty13 = mmd_loss(mod_params1[0].index_select(0, idx13), mod_params3[0].index_select(0, idx13))
+                penalties.append(penalty13)
 
-            if mask23.sum().gt(0):
-                penalty23 = mmd_loss(mod_params2[0][mask23], mod_params3[0][mask23])
-                pair_penalty = pair_penalty + penalty23
+            if has23:
+                idx23 = mask23.nonzero(as_tuple=True)[0]
+                penalty23 = mmd_loss(mod_params2[0].index_select(0, idx23), mod_params3[0].index_select(0, idx23))
+                penalties.append(penalty23)
 
-            pair_penalty *= 40
+            pair_penalty = 40 * self._sum_pair_penalties(penalties, mask1)
         elif self.modality_penalty == "RF":
-            pair_penalty = torch.zeros(mask1.shape[0], device=mask1.device, requires_grad=True)
-            alpha_rf = 0.1
-            if sum(bool(mask.item()) for mask in [mask12.sum().gt(0), mask13.sum().gt(0), mask14.sum().gt(0), mask23.sum().gt(0), mask24.sum().gt(0), mask34.sum().gt(0) ]) > 1:
+            if self.alpha_rf == 0:
+                return torch.zeros(mask1.shape[0], device=mask1.device)
+            penalties = []
+            # presence of all three pairs in a single device-to-host transfer, shared by the
+            # validity check and the flow evaluation
+            has12, has13, has23 = torch.stack((mask12, mask13, mask23)).any(dim=1).tolist()
+            if has12 + has13 + has23 > 1:
                 raise ValueError("RF only available for biomodal datasets.")
-            if alpha_rf > 0:
-                if mask12.sum().gt(0) and self.flow_top_to_bottom is not None:
-                    penalty12 = self.flow_top_to_bottom(mod_params1[0][mask12], mod_params2[0][mask12]) + self.flow_bottom_to_top(mod_params2[0][mask12], mod_params1[0][mask12])
-                    pair_penalty = pair_penalty + penalty12
-                if mask13.sum().gt(0) and self.flow_top_to_bottom is not None:
-                    penalty13 = self.flow_top_to_bottom(mod_params1[0][mask13], mod_params3[0][mask13]) + self.flow_bottom_to_top(mod_params3[0][mask13], mod_params1[0][mask13])
-                    pair_penalty = pair_penalty + penalty13
-                if mask23.sum().gt(0) and self.flow_top_to_bottom is not None:
-                    penalty23 = self.flow_top_to_bottom(mod_params2[0][mask23], mod_params3[0][mask23]) + self.flow_bottom_to_top(mod_params3[0][mask23], mod_params2[0][mask23])
-                    pair_penalty = pair_penalty + penalty23
+            if self.flow_top_to_bottom is not None:
+                # each pair is gathered once and reused for both flow directions
+                if has12:
+                    idx12 = mask12.nonzero(as_tuple=True)[0]
+                    z1, z2 = mod_params1[0].index_select(0, idx12), mod_params2[0].index_select(0, idx12)
+                    penalty12 = self.flow_top_to_bottom(z1, z2) + self.flow_bottom_to_top(z2, z1)
+                    penalties.append(penalty12)
+                if has13:
+                    idx13 = mask13.nonzero(as_tuple=True)[0]
+                    z1, z3 = mod_params1[0].index_select(0, idx13), mod_params3[0].index_select(0, idx13)
+                    penalty13 = self.flow_top_to_bottom(z1, z3) + self.flow_bottom_to_top(z3, z1)
+                    penalties.append(penalty13)
+                if has23:
+                    idx23 = mask23.nonzero(as_tuple=True)[0]
+                    z2, z3 = mod_params2[0].index_select(0, idx23), mod_params3[0].index_select(0, idx23)
+                    penalty23 = self.flow_top_to_bottom(z2, z3) + self.flow_bottom_to_top(z3, z2)
+                    penalties.append(penalty23)
+            pair_penalty = self.alpha_rf * self._sum_pair_penalties(penalties, mask1)
         else:
             raise ValueError("modality penalty not supported")
 
@@ -1476,10 +1766,11 @@ class NETWORKVAE(BaseModuleClass):
 @auto_move_data
 def sym_kld(qzm1, qzv1, qzm2, qzv2):
     """Symmetric KL divergence between two Gaussians."""
-    rv1 = Normal(qzm1, qzv1.sqrt())
-    rv2 = Normal(qzm2, qzv2.sqrt())
+    # closed form of KL(q1 || q2) + KL(q2 || q1) with variances qzv1/qzv2; the log-variance
+    # terms of both directions cancel
+    sq_diff = (qzm1 - qzm2).pow(2)
 
-    return kld(rv1, rv2) + kld(rv2, rv1)
+    return 0.5 * ((qzv1 + sq_diff) / qzv2 + (qzv2 + sq_diff) / qzv1) - 1.0
 
 
 @auto_move_data
@@ -1495,8 +1786,9 @@ def get_reconstruction_loss_protein(y, py_, pro_batch_mask_minibatch=None):
     reconst_loss_protein_full = -py_conditional.log_prob(y)
 
     if pro_batch_mask_minibatch is not None:
-        temp_pro_loss_full = pro_batch_mask_minibatch.bool() * reconst_loss_protein_full
-        rl_protein = temp_pro_loss_full.sum(dim=-1)
+        rl_protein = torch.where(
+            pro_batch_mask_minibatch.bool(), reconst_loss_protein_full, 0.0
+        ).sum(dim=-1)
     else:
         rl_protein = reconst_loss_protein_full.sum(dim=-1)
 
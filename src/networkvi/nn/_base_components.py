@@ -1244,13 +1244,26 @@ class FCLayers(nn.Module):
             for i in self.accumulated_activations
         }
 
+    @staticmethod
+    def _blockwise_linear(layer: nn.Linear, xs: list) -> torch.Tensor:
+        """Apply ``layer`` to the concatenation of ``xs`` without materializing it."""
+        x = None
+        start = 0
+        for x_block in xs:
+            stop = start + x_block.size(-1)
+            y = nn.functional.linear(x_block.to(layer.weight.dtype), layer.weight[:, start:stop])
+            x = y if x is None else x + y
+            start = stop
+        return x if layer.bias is None else x + layer.bias
+
     def forward(self, x: torch.Tensor, *cat_list: int, cont_input: torch.Tensor = None):
         """Forward computation on ``x``.
 
         Parameters
         ----------
         x
-            tensor of values with shape ``(n_in,)``
+            tensor of values with shape ``(n_in,)``, or a sequence of tensors whose
+            concatenation along the last dimension has that shape
         cat_list
             list of category membership(s) for this sample
 
@@ -1283,6 +1296,21 @@ class FCLayers(nn.Module):
                             x = torch.cat([(layer(slice_x)).unsqueeze(0) for slice_x in x], dim=0)
                         else:
                             x = layer(x)
+                    elif isinstance(x, (list, tuple)):
+                        # first layer on pre-split inputs: weight slices instead of a concat
+                        xs = list(x)
+                        if x[0].dim() == 3:
+                            xs += [
+                                o.unsqueeze(0).expand((x[0].size(0), o.size(0), o.size(1)))
+                                for o in one_hot_cat_list
+                            ]
+                        else:
+                            xs += one_hot_cat_list
+                        if cont_input is not None and len(cont_input) != 0:
+                            xs.append(cont_input)
+                        x = self._blockwise_linear(layer, xs)
+                        if self.keep_activations and i_layer == len(layers)-1:
+                           self.accumulated_activations[i].append(x.cpu().detach().numpy())
                     else:
                         if isinstance(layer, nn.Linear) and self.inject_into_layer(i):
                             if x.dim() == 3:
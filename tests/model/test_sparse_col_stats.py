@@ -0,0 +1,84 @@
+import anndata
+import numpy as np
+import pytest
+import scipy.sparse as sp_sparse
+
+from networkvi.model._utils import (
+    _sparse_col_positive_proportion,
+    _sparse_col_stats,
+    scrna_raw_counts_properties,
+)
+
+
+def _dense_col_stats(X, idx, scaling_factor, var_idx):
+    data = X[idx]
+    if var_idx is not None:
+        data = data[:, var_idx]
+    n = data.shape[0]
+    return (
+        data.sum(axis=0) / n,
+        np.count_nonzero(data, axis=0) / n,
+        scaling_factor[idx] @ data / n,
+    )
+
+
+@pytest.mark.parametrize("var_idx", [None, [7, 2, 2, 0, 11], np.arange(12) % 2 == 0])
+@pytest.mark.parametrize("fmt", ["csr", "csc"])
+def test_sparse_col_stats_matches_dense(var_idx, fmt):
+    rng = np.random.default_rng(0)
+    X = rng.poisson(0.5, size=(50, 12)).astype(np.float32)
+    X[:, 3] = 0
+    scaling_factor = rng.uniform(0.5, 2.0, size=50).astype(np.float32)
+    # repeated row indices count once per occurrence, like in `X[idx]`
+    idx1 = np.array([0, 3, 3, 7, 10, 10, 10, 49])
+    idx2 = rng.random(50) < 0.4
+
+    stats = _sparse_col_stats(
+        sp_sparse.csr_matrix(X).asformat(fmt), [idx1, idx2], scaling_factor, var_idx
+    )
+    for idx, group_stats in zip([idx1, idx2], stats):
+        for actual, expected in zip(group_stats, _dense_col_stats(X, idx, scaling_factor, var_idx)):
+            np.testing.assert_allclose(actual, expected, rtol=1e-5)
+
+
+
+
+@pytest.mark.parametrize("var_idx", [None, [5, 1, 1, 9]])
+@pytest.mark.parametrize("fmt", ["csr", "csc", "coo"])
+def test_sparse_col_positive_proportion_matches_dense(var_idx, fmt):
+    rng = np.random.default_rng(3)
+    X = rng.poisson(0.5, size=(40, 10)).astype(np.float32)
+    # stored negative entries are not positive
+    X[rng.random(X.shape) < 0.1] = -1
+    idx1 = np.array([2, 2, 8, 39, 39])
+    idx2 = rng.random(40) < 0.5
+
+    proportions = _sparse_col_positive_proportion(
+        sp_sparse.csr_matrix(X).asformat(fmt), [idx1, idx2], var_idx
+    )
+    for idx, proportion in zip([idx1, idx2], proportions):
+        data = X[idx] if var_idx is None else X[idx][:, var_idx]
+        np.testing.assert_allclose(proportion, np.count_nonzero(data > 0, axis=0) / data.shape[0])
+
+class _AdataManager:
+    def __init__(self, X):
+        self.adata = anndata.AnnData(X)
+
+    def get_from_registry(self, key):
+        return self.adata.X
+
+
+@pytest.mark.parametrize("fmt", ["csr", "csc"])
+def test_raw_counts_properties_zero_count_cells(fmt):
+    rng = np.random.default_rng(2)
+    X = rng.poisson(1.0, size=(30, 8)).astype(np.float32)
+    # cells without any counts get a zero normalized expression on both paths
+    X[[0, 5, 17]] = 0
+    idx1 = np.arange(10)
+    idx2 = np.arange(10, 30)
+
+    dense = scrna_raw_counts_properties(_AdataManager(X), idx1, idx2)
+    sparse = scrna_raw_counts_properties(_AdataManager(sp_sparse.csr_matrix(X).asformat(fmt)), idx1, idx2)
+    for key, value in dense.items():
+        assert np.isfinite(value).all()
+        np.testing.assert_allclose(sparse[key], value, rtol=1e-5)
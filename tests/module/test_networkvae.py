@@ -0,0 +1,130 @@
+import pytest
+import torch
+
+from networkvi import REGISTRY_KEYS
+from networkvi.module._networkvae import NETWORKVAE, RBF, MMDLoss, RandomFourierFeatures
+
+N_REGIONS, N_GENES, N_PROTEINS = 15, 12, 5
+
+
+def _module(**kwargs):
+    torch.manual_seed(0)
+    module_kwargs = {
+        "n_input_regions": N_REGIONS,
+        "n_input_genes": N_GENES,
+        "n_input_proteins": N_PROTEINS,
+        "n_batch": 2,
+        "n_obs": 20,
+        "n_labels": 2,
+        "layers_encoder_type": "linear",
+        "layers_decoder_type": "linear",
+        "library_size_layers_type": "linear",
+        "expression_gene_layer_type": "none",
+        "accessibility_gene_layer_type": "none",
+        "protein_gene_layer_type": "none",
+        "n_hidden": 8,
+        "n_latent": 4,
+        "modality_weights": "moe",
+    }
+    module_kwargs.update(kwargs)
+    return NETWORKVAE(**module_kwargs)
+
+
+def _tensors(n=20):
+    generator = torch.Generator().manual_seed(1)
+    x = torch.poisson(torch.rand(n, N_GENES + N_REGIONS, generator=generator) * 2)
+    # cells without expression and cells without accessibility
+    x[:4, :N_GENES] = 0
+    x[4:8, N_GENES:] = 0
+    y = torch.poisson(torch.rand(n, N_PROTEINS, generator=generator) * 3)
+    y[8:12] = 0
+    return {
+        REGISTRY_KEYS.X_KEY: x,
+        REGISTRY_KEYS.PROTEIN_EXP_KEY: y,
+        REGISTRY_KEYS.BATCH_KEY: torch.randint(0, 2, (n, 1), generator=generator),
+        REGISTRY_KEYS.PATIENT_KEY: torch.zeros(n, 1),
+        REGISTRY_KEYS.LABELS_KEY: torch.randint(0, 2, (n, 1), generator=generator),
+        REGISTRY_KEYS.INDICES_KEY: torch.arange(n).unsqueeze(1),
+    }
+
+
+def _forward_loss(module):
+    _, generative_outputs, losses = module(_tensors())
+    assert torch.isfinite(losses.loss)
+    losses.loss.backward()
+    return generative_outputs, losses
+
+
+@pytest.mark.parametrize("gene_likelihood", ["zinb", "nb"])
+@pytest.mark.parametrize("gene_dispersion", ["gene", "gene-batch", "gene-label"])
+def test_networkvae_gene_dispersion(gene_dispersion, gene_likelihood):
+    module = _module(gene_dispersion=gene_dispersion, gene_likelihood=gene_likelihood)
+    generative_outputs, _ = _forward_loss(module)
+    # the returned dispersion is the one used by the loss, per cell unless shared by all cells
+    expected_shape = (N_GENES,) if gene_dispersion == "gene" else (20, N_GENES)
+    assert generative_outputs["px_r"].shape == expected_shape
+
+
+@pytest.mark.parametrize("modality_penalty", ["Jeffreys", "MMD", "realMMD", "None"])
+def test_networkvae_modality_penalty(modality_penalty):
+    _forward_loss(_module(modality_penalty=modality_penalty))
+
+
+@pytest.mark.parametrize("kwargs", [{"block_gating": True}, {"bf16_submodules": True}])
+def test_networkvae_gating_options(kwargs):
+    _forward_loss(_module(modality_penalty="realMMD", **kwargs))
+
+
+def test_networkvae_moe_weights_must_match_modalities():
+    module = _module()
+    mus = [torch.randn(6, 4) for _ in range(3)]
+    vars = [torch.rand(6, 4) for _ in range(3)]
+    masks = [torch.ones(6) for _ in range(3)]
+    with pytest.raises(ValueError):
+        module.mix_modalities_moe(mus, vars, masks, torch.full((6, 4), 0.25))
+
+
+def test_mmd_loss_too_few_samples():
+    assert MMDLoss()(torch.randn(1, 3), torch.randn(5, 3)) == 0
+
+
+def test_mmd_loss_exact_blocks_match_full_gram():
+    X, Y = torch.randn(30, 3), torch.randn(20, 3) + 0.5
+    K = RBF()(torch.vstack([X, Y]))
+    expected = K[:30, :30].mean() - 2 * K[:30, 30:].mean() + K[30:, 30:].mean()
+    torch.testing.assert_close(MMDLoss()(X, Y), expected)
+
+
+def test_mmd_loss_generic_kernel():
+    class Linear(torch.nn.Module):
+        def forward(self, X):
+            return X @ X.T
+
+    X, Y = torch.randn(10, 3), torch.randn(12, 3)
+    expected = (X.mean(dim=0) - Y.mean(dim=0)).pow(2).sum()
+    torch.testing.assert_close(MMDLoss(kernel=Linear())(X, Y), expected)
+
+
+def test_mmd_loss_random_features_threshold():
+    torch.manual_seed(0)
+    X, Y = torch.randn(300, 4), torch.randn(300, 4) + 0.2
+    exact = MMDLoss()(X, Y)
+    approx_loss = MMDLoss(approx_kernel=RandomFourierFeatures(), approx_threshold=256)
+    # the exact kernel is kept up to the threshold
+    torch.testing.assert_close(approx_loss(X[:256], Y[:256]), MMDLoss()(X[:256], Y[:256]))
+
+    state = torch.random.get_rng_state()
+    approx = approx_loss(X, Y)
+    # the features come from their own seeded generator
+    assert torch.equal(torch.random.get_rng_state(), state)
+    assert approx != exact
+    torch.testing.assert_close(approx, exact, atol=0.02, rtol=0.5)
+    torch.testing.assert_close(MMDLoss(approx_kernel=RandomFourierFeatures())(X, Y), approx)
+
+
+def test_mmd_loss_autocast_bf16():
+    torch.manual_seed(0)
+    X, Y = torch.randn(40, 4), torch.randn(40, 4) + 0.5
+    loss = MMDLoss(autocast_bf16=True)(X, Y)
+    assert loss.dtype == X.dtype
+    torch.testing.assert_close(loss, MMDLoss()(X, Y), atol=1e-2, rtol=5e-2)